@@ -0,0 +1,313 @@
+"""Évaluation hors ligne des configurations Isolation Forest.
+
+La matrice de features labellisée est construite une seule fois puis mise
+en cache (mémoire + disque) ; chaque configuration de la grille est
+ensuite évaluée en parallèle sur un jeu de test réservé.
+
+Seules les lignes avec un feedback humain (``actual_anomaly``) servent de
+vérité terrain ; les autres labels viennent du détecteur de production et
+ne mesurent que l'accord avec lui (métriques ``detector_*``).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import pickle
+import time
+from typing import Dict, List, Optional, Tuple
+
+import joblib
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.ensemble import IsolationForest
+from sklearn.metrics import f1_score, precision_score, recall_score
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import StandardScaler
+
+CACHE_TTL = int(os.getenv('ML_EVAL_CACHE_TTL', str(6 * 3600)))
+LATENCY_ROUNDS = 50
+MIN_FEEDBACK_LABELS = int(os.getenv('ML_EVAL_MIN_FEEDBACK', '30'))
+
+# Moitié des cœurs par défaut pour ne pas affamer detect_anomaly
+DEFAULT_N_JOBS = int(os.getenv('ML_EVAL_N_JOBS', str(max(1, (os.cpu_count() or 1) // 2))))
+
+DEFAULT_CONTAMINATION = [0.01, 0.03, 0.05, 0.1]
+DEFAULT_N_ESTIMATORS = [100, 200]
+DEFAULT_MAX_SAMPLES = ['auto', 256]
+SELECTION_METRICS = ('f1', 'precision', 'recall')
+
+# Matrices en mémoire : clé -> (X, y, masque feedback, meta)
+_matrix_cache: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray, Dict]] = {}
+
+
+def _cache_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, f'{key}_features.joblib')
+
+
+def load_cached_matrix(cache_dir: str, key: str) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, Dict]]:
+    """Récupérer une matrice labellisée encore valide (mémoire puis disque)"""
+    entry = _matrix_cache.get(key)
+
+    if entry is None:
+        path = _cache_path(cache_dir, key)
+        if not os.path.exists(path):
+            return None
+        entry = joblib.load(path)
+        _matrix_cache[key] = entry
+
+    if time.time() - entry[3]['built_at'] > CACHE_TTL:
+        invalidate_cached_matrix(cache_dir, key)
+        return None
+
+    return entry
+
+
+def save_cached_matrix(cache_dir: str, key: str, X: np.ndarray, y: np.ndarray,
+                       feedback: np.ndarray, meta: Dict):
+    """Mettre en cache une matrice labellisée et son masque de feedback"""
+    meta = {**meta, 'built_at': time.time()}
+    os.makedirs(cache_dir, exist_ok=True)
+    joblib.dump((X, y, feedback, meta), _cache_path(cache_dir, key))
+    _matrix_cache[key] = (X, y, feedback, meta)
+    return X, y, feedback, meta
+
+
+def invalidate_cached_matrix(cache_dir: str, key: str):
+    """Supprimer une matrice du cache"""
+    _matrix_cache.pop(key, None)
+    path = _cache_path(cache_dir, key)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def build_grid(contamination: List, n_estimators: List[int], max_samples: List) -> List[Dict]:
+    """Produit cartésien des hyperparamètres candidats"""
+    return [
+        {'contamination': c, 'n_estimators': n, 'max_samples': m}
+        for c, n, m in itertools.product(contamination, n_estimators, max_samples)
+    ]
+
+
+def prepare_split(X: np.ndarray, y: np.ndarray, feedback: np.ndarray, test_size: float = 0.3,
+                  random_state: int = 42) -> Tuple[np.ndarray, ...]:
+    """Séparer train/test puis normaliser (le scaler est commun à toute la grille)"""
+    # Stratifier sur (label, feedback) pour répartir les lignes labellisées par un humain,
+    # seulement si chaque strate a assez d'exemples
+    strata = y * 2 + feedback.astype(int)
+    counts = np.bincount(strata)
+    stratify = strata if counts[counts > 0].min() >= 2 else None
+    X_train, X_test, y_train, y_test, _, feedback_test = train_test_split(
+        X, y, feedback, test_size=test_size, random_state=random_state, stratify=stratify
+    )
+
+    scaler = StandardScaler()
+    X_train = scaler.fit_transform(X_train)
+    X_test = scaler.transform(X_test)
+
+    return X_train, X_test, y_train, y_test, feedback_test
+
+
+def _scores(y_true: np.ndarray, predicted: np.ndarray, prefix: str = '') -> Dict:
+    """Précision, rappel et F1 (0 si aucune ligne)"""
+    if len(y_true) == 0:
+        return {f'{prefix}precision': 0.0, f'{prefix}recall': 0.0, f'{prefix}f1': 0.0}
+
+    return {
+        f'{prefix}precision': float(precision_score(y_true, predicted, zero_division=0)),
+        f'{prefix}recall': float(recall_score(y_true, predicted, zero_division=0)),
+        f'{prefix}f1': float(f1_score(y_true, predicted, zero_division=0))
+    }
+
+
+def evaluate_config(config: Dict, X_train: np.ndarray, X_test: np.ndarray, y_test: np.ndarray,
+                    feedback_test: np.ndarray, random_state: int = 42) -> Tuple[Dict, IsolationForest]:
+    """Entraîner une configuration et mesurer ses performances sur le jeu réservé.
+
+    ``precision``/``recall``/``f1`` portent sur les lignes avec feedback,
+    ``detector_*`` sur les autres. Le modèle est renvoyé pour que la
+    latence soit mesurée hors des workers.
+    """
+    model = IsolationForest(random_state=random_state, n_jobs=1, **config)
+
+    start = time.perf_counter()
+    model.fit(X_train)
+    fit_seconds = time.perf_counter() - start
+
+    predicted = (model.predict(X_test) == -1).astype(int)
+
+    result = {
+        'config': config,
+        **_scores(y_test[feedback_test], predicted[feedback_test]),
+        **_scores(y_test[~feedback_test], predicted[~feedback_test], prefix='detector_'),
+        'flagged_ratio': float(predicted.mean()),
+        'fit_seconds': round(fit_seconds, 4),
+        'model_size_bytes': len(pickle.dumps(model))
+    }
+    return result, model
+
+
+def measure_latency(model: IsolationForest, row: np.ndarray) -> Dict:
+    """Latence de scoring d'une seule ligne, comme dans detect_anomaly"""
+    latencies = []
+    for _ in range(LATENCY_ROUNDS):
+        start = time.perf_counter()
+        model.score_samples(row)
+        model.predict(row)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        'latency_p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 4),
+        'latency_p95_ms': round(float(np.percentile(latencies, 95)) * 1000, 4)
+    }
+
+
+def evaluate_grid(configs: List[Dict], X_train: np.ndarray, X_test: np.ndarray, y_test: np.ndarray,
+                  feedback_test: np.ndarray, n_jobs: int = DEFAULT_N_JOBS) -> List[Dict]:
+    """Évaluer toutes les configurations en parallèle sur plusieurs cœurs.
+
+    Les entraînements sont parallèles ; la latence est ensuite mesurée
+    séquentiellement pour ne pas être faussée par les autres workers.
+    """
+    # joblib (loky) partage les grosses matrices via memmap entre les workers
+    evaluated = Parallel(n_jobs=n_jobs)(
+        delayed(evaluate_config)(config, X_train, X_test, y_test, feedback_test) for config in configs
+    )
+
+    row = X_test[:1]
+    return [{**result, **measure_latency(model, row)} for result, model in evaluated]
+
+
+def select_best(results: List[Dict], metric: str = 'f1') -> Optional[Dict]:
+    """Meilleure configuration selon la métrique, latence la plus faible à égalité"""
+    if not results:
+        return None
+    return max(results, key=lambda r: (r[metric], -r['latency_p50_ms']))
+
+
+def run_grid(X: np.ndarray, y: np.ndarray, feedback: np.ndarray, configs: List[Dict],
+             test_size: float = 0.3, n_jobs: int = DEFAULT_N_JOBS, metric: str = 'f1',
+             baseline: Optional[Dict] = None) -> Dict:
+    """Évaluer une grille sur une matrice labellisée.
+
+    ``baseline`` (configuration de production) est évaluée sur le même split
+    mais ne fait pas partie des candidats.
+    """
+    X_train, X_test, y_train, y_test, feedback_test = prepare_split(X, y, feedback, test_size)
+
+    start = time.perf_counter()
+    results = evaluate_grid(
+        configs + ([baseline] if baseline else []), X_train, X_test, y_test, feedback_test, n_jobs
+    )
+    elapsed = time.perf_counter() - start
+
+    baseline_result = results.pop() if baseline else None
+
+    results.sort(key=lambda r: (r[metric], -r['latency_p50_ms']), reverse=True)
+
+    return {
+        'train_samples': int(len(y_train)),
+        'test_samples': int(len(y_test)),
+        'test_feedback_labels': int(feedback_test.sum()),
+        'test_feedback_anomalies': int(y_test[feedback_test].sum()),
+        'test_detector_anomalies': int(y_test[~feedback_test].sum()),
+        'metric': metric,
+        'evaluation_seconds': round(elapsed, 3),
+        'best': select_best(results, metric),
+        'baseline': baseline_result,
+        'results': results
+    }
+
+
+def promotion_blocker(report: Dict) -> Optional[str]:
+    """Raison de ne pas promouvoir le meilleur candidat, None s'il est promouvable"""
+    metric = report['metric']
+    best = report['best']
+    baseline = report.get('baseline')
+
+    if report['test_feedback_labels'] < MIN_FEEDBACK_LABELS:
+        return (f"Pas assez de feedback dans le jeu de test "
+                f"({report['test_feedback_labels']} < {MIN_FEEDBACK_LABELS})")
+    if report['test_feedback_anomalies'] == 0:
+        return "Aucune anomalie confirmée par feedback dans le jeu de test"
+    if best is None or best[metric] <= 0:
+        return f"Aucun candidat avec {metric} > 0"
+    if baseline is not None and best[metric] <= baseline[metric]:
+        return (f"Le meilleur candidat ({metric}={best[metric]:.3f}) ne bat pas "
+                f"la configuration de production ({metric}={baseline[metric]:.3f})")
+    return None
+
+
+def _parse_param(value: str):
+    """'auto' reste une chaîne, sinon entier ou flottant"""
+    if value == 'auto':
+        return value
+    return float(value) if '.' in value else int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Évaluer une grille de configurations Isolation Forest")
+    parser.add_argument('--route-id', default=None)
+    parser.add_argument('--contamination', nargs='+', type=float, default=DEFAULT_CONTAMINATION)
+    parser.add_argument('--n-estimators', nargs='+', type=int, default=DEFAULT_N_ESTIMATORS)
+    parser.add_argument('--max-samples', nargs='+', type=_parse_param, default=DEFAULT_MAX_SAMPLES)
+    parser.add_argument('--test-size', type=float, default=0.3)
+    parser.add_argument('--n-jobs', type=int, default=DEFAULT_N_JOBS)
+    parser.add_argument('--metric', choices=SELECTION_METRICS, default='f1')
+    parser.add_argument('--refresh-cache', action='store_true')
+    parser.add_argument('--promote', action='store_true',
+                        help="Évaluer et promouvoir via le service en cours d'exécution")
+    parser.add_argument('--service-url', default=os.getenv('ML_SERVICE_URL', 'http://localhost:8000'))
+    args = parser.parse_args()
+
+    payload = {
+        'route_id': args.route_id,
+        'contamination': args.contamination,
+        'n_estimators': args.n_estimators,
+        'max_samples': args.max_samples,
+        'test_size': args.test_size,
+        'n_jobs': args.n_jobs,
+        'metric': args.metric,
+        'refresh_cache': args.refresh_cache,
+        'promote': args.promote
+    }
+
+    if args.promote:
+        # Le modèle actif vit dans le processus uvicorn : la promotion doit s'y faire
+        report = _evaluate_via_service(args.service_url, payload)
+    else:
+        report = asyncio.run(_evaluate_locally(payload))
+
+    print(json.dumps(report, indent=2, default=str))
+
+
+def _evaluate_via_service(service_url: str, payload: Dict) -> Dict:
+    """Déléguer l'évaluation (et la promotion) à l'endpoint admin du service"""
+    import httpx
+
+    response = httpx.post(
+        f"{service_url.rstrip('/')}/api/admin/model/evaluate",
+        json=payload,
+        headers={'X-Admin-Token': os.getenv('ML_ADMIN_TOKEN', '')},
+        timeout=None
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+async def _evaluate_locally(payload: Dict) -> Dict:
+    """Évaluer dans ce processus, sans toucher au modèle servi"""
+    import app
+
+    request = app.EvaluationRequest(**payload)
+    await app.connect()
+    try:
+        return await app.run_evaluation(request)
+    finally:
+        await app.disconnect()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
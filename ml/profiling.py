@@ -0,0 +1,271 @@
+"""Profilage à la demande des chemins critiques du service ML.
+
+Une session de profilage est bornée dans le temps et démarrée par un admin.
+Hors session, les fonctions instrumentées avec ``@profiled`` ne paient qu'un
+test sur une variable globale.
+"""
+import cProfile
+import functools
+import io
+import json
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, Optional
+
+PROFILING_MODES = ('timing', 'cprofile', 'sampling')
+REPORT_FORMATS = ('json', 'pstats', 'collapsed')
+
+MAX_PROFILING_DURATION = int(os.getenv('ML_PROFILING_MAX_DURATION', '300'))
+ALLOCATION_TOP_N = 25
+
+# Session en cours et dernier rapport terminé
+_session: Optional['ProfilingSession'] = None
+_last_report: Optional[Dict] = None
+_lock = threading.Lock()
+
+
+class ProfilingError(Exception):
+    """Erreur de pilotage d'une session de profilage"""
+
+
+class _StackSampler(threading.Thread):
+    """Échantillonne périodiquement la pile d'un thread cible"""
+
+    def __init__(self, target_thread_id: int, interval: float):
+        super().__init__(name='ml-profiling-sampler', daemon=True)
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is None:
+                continue
+            self.stacks[_collapse_frame(frame)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _collapse_frame(frame) -> str:
+    """Convertir une pile en ligne « collapsed stacks » (racine en premier)"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class ProfilingSession:
+    """Fenêtre de profilage active"""
+
+    def __init__(self, mode: str, duration: float, sample_interval_ms: int = 10,
+                 trace_allocations: bool = False):
+        self.mode = mode
+        self.duration = duration
+        self.sample_interval_ms = sample_interval_ms
+        self.trace_allocations = trace_allocations
+        self.started_at = datetime.utcnow()
+        self.deadline = time.monotonic() + duration
+        self.timings = defaultdict(list)
+        self.allocations = []
+        self._profiler = None
+        self._sampler = None
+        self._started_tracemalloc = False
+
+    def start(self):
+        if self.mode == 'cprofile':
+            # cProfile ne suit que le thread courant, i.e. la boucle asyncio
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.mode == 'sampling':
+            self._sampler = _StackSampler(threading.get_ident(), self.sample_interval_ms / 1000)
+            self._sampler.start()
+
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def stop(self) -> Dict:
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self._sampler is not None:
+            self._sampler.stop()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+        return self.build_report()
+
+    def record(self, name: str, elapsed: float):
+        self.timings[name].append(elapsed)
+
+    def build_report(self) -> Dict:
+        timings = {}
+        for name, durations in self.timings.items():
+            timings[name] = {
+                'calls': len(durations),
+                'total_ms': round(sum(durations) * 1000, 3),
+                'mean_ms': round(sum(durations) / len(durations) * 1000, 3),
+                'max_ms': round(max(durations) * 1000, 3)
+            }
+
+        report = {
+            'mode': self.mode,
+            'started_at': self.started_at.isoformat(),
+            'stopped_at': datetime.utcnow().isoformat(),
+            'duration_requested': self.duration,
+            'timings': timings,
+            'allocations': self.allocations,
+            'pstats': None,
+            'collapsed': None
+        }
+
+        if self._profiler is not None:
+            report['pstats'] = marshal.dumps(pstats.Stats(self._profiler).stats)
+            summary = io.StringIO()
+            pstats.Stats(self._profiler, stream=summary).sort_stats('cumulative').print_stats(30)
+            report['pstats_summary'] = summary.getvalue()
+        if self._sampler is not None:
+            report['samples'] = self._sampler.samples
+            report['collapsed'] = '\n'.join(
+                f"{stack} {count}" for stack, count in self._sampler.stacks.most_common()
+            )
+
+        return report
+
+
+def start_session(mode: str, duration: float, sample_interval_ms: int = 10,
+                  trace_allocations: bool = False) -> ProfilingSession:
+    """Démarrer une session de profilage bornée"""
+    global _session
+
+    if mode not in PROFILING_MODES:
+        raise ProfilingError(f"Mode inconnu: {mode}")
+    if not 0 < duration <= MAX_PROFILING_DURATION:
+        raise ProfilingError(f"Durée invalide (max {MAX_PROFILING_DURATION}s)")
+    if sample_interval_ms < 1:
+        raise ProfilingError("Intervalle d'échantillonnage invalide")
+
+    with _lock:
+        if _session is not None:
+            raise ProfilingError("Une session de profilage est déjà active")
+        session = ProfilingSession(mode, duration, sample_interval_ms, trace_allocations)
+        session.start()
+        _session = session
+
+    return session
+
+
+def stop_session(session: Optional[ProfilingSession] = None) -> Optional[Dict]:
+    """Arrêter la session en cours et conserver son rapport.
+
+    Si ``session`` est fourni, n'arrête que cette session (utilisé par
+    l'arrêt automatique pour ne pas couper une session plus récente).
+    """
+    global _session, _last_report
+
+    with _lock:
+        if _session is None or (session is not None and _session is not session):
+            return None
+        current, _session = _session, None
+
+    _last_report = current.stop()
+    return _last_report
+
+
+def get_status() -> Dict:
+    """État de la session en cours"""
+    session = _session
+    if session is None:
+        return {'active': False, 'last_report_available': _last_report is not None}
+
+    return {
+        'active': True,
+        'mode': session.mode,
+        'started_at': session.started_at.isoformat(),
+        'remaining_seconds': max(0.0, round(session.deadline - time.monotonic(), 1)),
+        'trace_allocations': session.trace_allocations,
+        'last_report_available': _last_report is not None
+    }
+
+
+def export_report(fmt: str) -> bytes:
+    """Exporter le dernier rapport dans le format demandé"""
+    if fmt not in REPORT_FORMATS:
+        raise ProfilingError(f"Format inconnu: {fmt}")
+    if _last_report is None:
+        raise ProfilingError("Aucun rapport de profilage disponible")
+
+    if fmt == 'json':
+        payload = {k: v for k, v in _last_report.items() if k not in ('pstats', 'collapsed')}
+        return json.dumps(payload, indent=2).encode()
+
+    data = _last_report.get(fmt)
+    if data is None:
+        raise ProfilingError(f"Format {fmt} indisponible pour le mode {_last_report['mode']}")
+    return data if isinstance(data, bytes) else data.encode()
+
+
+def profiled(name: str, allocations: bool = False):
+    """Instrumenter une coroutine pour les sessions de profilage.
+
+    Avec ``allocations=True``, un snapshot tracemalloc est pris avant et
+    après l'appel quand la session trace les allocations.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            session = _session
+            if session is None:
+                return await func(*args, **kwargs)
+
+            snapshot = None
+            if allocations and session.trace_allocations and tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                session.record(name, time.perf_counter() - start)
+                if snapshot is not None and tracemalloc.is_tracing():
+                    session.allocations.append(_allocation_diff(name, snapshot, args, kwargs))
+        return wrapper
+    return decorator
+
+
+def _allocation_diff(name: str, before, args, kwargs) -> Dict:
+    """Différence d'allocations entre un snapshot et l'état courant"""
+    after = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    stats = after.compare_to(before, 'lineno')[:ALLOCATION_TOP_N]
+
+    return {
+        'function': name,
+        'arguments': [repr(a) for a in args] + [f"{k}={v!r}" for k, v in kwargs.items()],
+        'taken_at': datetime.utcnow().isoformat(),
+        'traced_current_bytes': current,
+        'traced_peak_bytes': peak,
+        'top': [
+            {
+                'location': str(stat.traceback),
+                'size_diff_bytes': stat.size_diff,
+                'size_bytes': stat.size,
+                'count_diff': stat.count_diff
+            }
+            for stat in stats
+        ]
+    }
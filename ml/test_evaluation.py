@@ -0,0 +1,347 @@
+import asyncio
+import json
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('sklearn')
+
+import evaluation
+
+
+@pytest.fixture
+def labelled_matrix():
+    rng = np.random.RandomState(0)
+    normal = rng.normal(0, 1, size=(380, 7))
+    outliers = rng.normal(6, 1, size=(20, 7))
+    X = np.vstack([normal, outliers])
+    y = np.array([0] * 380 + [1] * 20)
+    # Human feedback on every other row
+    feedback = np.arange(400) % 2 == 0
+    return X, y, feedback
+
+
+def test_build_grid():
+    """The grid is the cartesian product of the candidates"""
+    grid = evaluation.build_grid([0.01, 0.05], [100], ['auto', 256])
+    assert len(grid) == 4
+    assert {'contamination': 0.05, 'n_estimators': 100, 'max_samples': 256} in grid
+
+
+def test_run_grid_reports_metrics(labelled_matrix):
+    """Each configuration gets held-out metrics, latency and size"""
+    X, y, feedback = labelled_matrix
+    configs = evaluation.build_grid([0.05, 0.1], [50], ['auto'])
+    report = evaluation.run_grid(X, y, feedback, configs, n_jobs=2)
+
+    assert report['test_samples'] == 120
+    assert report['test_feedback_labels'] == 60
+    assert report['test_feedback_anomalies'] == 3
+    assert report['test_detector_anomalies'] == 3
+    assert len(report['results']) == 2
+    for result in report['results']:
+        assert 0 <= result['precision'] <= 1
+        assert 0 <= result['detector_precision'] <= 1
+        assert result['latency_p50_ms'] > 0
+        assert result['model_size_bytes'] > 0
+    assert report['best'] is report['results'][0]
+    assert report['best']['recall'] > 0.5
+
+
+def test_matrix_cache(tmp_path, labelled_matrix):
+    """Cached matrices are reused until invalidated"""
+    X, y, feedback = labelled_matrix
+    evaluation.save_cached_matrix(str(tmp_path), 'global', X, y, feedback, {'samples': len(y)})
+    evaluation._matrix_cache.clear()
+
+    cached = evaluation.load_cached_matrix(str(tmp_path), 'global')
+    assert np.array_equal(cached[0], X)
+    assert np.array_equal(cached[2], feedback)
+    assert cached[3]['samples'] == len(y)
+
+    evaluation.invalidate_cached_matrix(str(tmp_path), 'global')
+    assert evaluation.load_cached_matrix(str(tmp_path), 'global') is None
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def set(self, key, value):
+        self.store[key] = value.encode() if isinstance(value, str) else value
+
+    async def setex(self, key, ttl, value):
+        await self.set(key, value)
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetch(self, query, *args):
+        return self.rows
+
+
+class FakePool:
+    def __init__(self, rows):
+        self.conn = FakeConnection(rows)
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                return pool.conn
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return Acquire()
+
+
+def training_frame(n=200, anomalies=10):
+    pd = pytest.importorskip('pandas')
+    rng = np.random.RandomState(1)
+    X = np.vstack([rng.normal(0, 1, size=(n - anomalies, 7)), rng.normal(6, 1, size=(anomalies, 7))])
+    df = pd.DataFrame(X, columns=[
+        'price_ratio', 'z_score', 'day_of_week', 'days_until_departure',
+        'trip_duration', 'seasonal_factor', 'price_variance'
+    ])
+    df['id'] = [f'ph-{i}' for i in range(n)]
+    df['is_anomaly'] = [False] * (n - anomalies) + [True] * anomalies
+    return df
+
+
+@pytest.fixture
+def ml_app(tmp_path, monkeypatch):
+    app = pytest.importorskip('app')
+    evaluation._matrix_cache.clear()
+    monkeypatch.setattr(app, 'MODEL_PATH', str(tmp_path))
+    monkeypatch.setattr(app, 'EVAL_CACHE_PATH', str(tmp_path / 'eval'))
+    monkeypatch.setattr(app, 'redis_client', FakeRedis())
+    monkeypatch.setattr(app, 'db_pool', FakePool([]))
+    monkeypatch.setattr(app, 'models', {})
+    monkeypatch.setattr(app, 'scalers', {})
+    yield app
+    evaluation._matrix_cache.clear()
+
+
+def use_frame(app, monkeypatch, df, feedback=()):
+    async def get_training_data(route_id=None):
+        return df.copy()
+
+    monkeypatch.setattr(app, 'get_training_data', get_training_data)
+    monkeypatch.setattr(app, 'db_pool', FakePool([
+        {'price_history_id': ph_id, 'actual_anomaly': actual} for ph_id, actual in feedback
+    ]))
+
+
+def all_feedback(df):
+    """Human feedback confirming is_anomaly on every row"""
+    return list(zip(df['id'], df['is_anomaly']))
+
+
+@pytest.mark.parametrize('anomalies, with_feedback', [
+    (10, False),  # detector labels only: no ground truth
+    (0, True)     # feedback without any confirmed anomaly
+])
+def test_no_promotion_without_feedback_anomalies(ml_app, monkeypatch, anomalies, with_feedback):
+    """Promotion needs anomalies confirmed by human feedback"""
+    df = training_frame(anomalies=anomalies)
+    use_frame(ml_app, monkeypatch, df, feedback=all_feedback(df) if with_feedback else ())
+
+    request = ml_app.EvaluationRequest(contamination=[0.05], n_estimators=[50], max_samples=['auto'],
+                                       n_jobs=1, promote=True)
+    report = asyncio.run(ml_app.run_evaluation(request))
+
+    assert report['test_feedback_anomalies'] == 0
+    assert report['test_detector_anomalies'] == (0 if with_feedback else 3)
+    assert report['promoted'] is False
+    assert report['promotion_blocked']
+    assert ml_app.redis_client.store == {}
+    assert ml_app.models == {}
+
+
+def test_no_promotion_when_baseline_is_not_beaten():
+    """A candidate must beat the production configuration"""
+    report = {
+        'metric': 'f1',
+        'test_feedback_labels': evaluation.MIN_FEEDBACK_LABELS,
+        'test_feedback_anomalies': 3,
+        'best': {'f1': 0.5},
+        'baseline': {'f1': 0.5}
+    }
+    assert evaluation.promotion_blocker(report)
+
+    report['best'] = {'f1': 0.6}
+    assert evaluation.promotion_blocker(report) is None
+
+    report['test_feedback_labels'] = evaluation.MIN_FEEDBACK_LABELS - 1
+    assert 'feedback' in evaluation.promotion_blocker(report)
+    report['test_feedback_labels'] = evaluation.MIN_FEEDBACK_LABELS
+
+    report['best'] = {'f1': 0.0}
+    report['baseline'] = None
+    assert evaluation.promotion_blocker(report)
+
+
+def test_promotion_beats_baseline(ml_app, monkeypatch):
+    """The best candidate is promoted when it beats production"""
+    df = training_frame()
+    use_frame(ml_app, monkeypatch, df, feedback=all_feedback(df))
+    # Deliberately poor production configuration
+    asyncio.run(ml_app.redis_client.set('ml:model:config:global', json.dumps({'contamination': 0.5})))
+
+    request = ml_app.EvaluationRequest(contamination=[0.05], n_estimators=[50], max_samples=['auto'],
+                                       n_jobs=1, promote=True)
+    report = asyncio.run(ml_app.run_evaluation(request))
+
+    assert report['baseline']['config']['contamination'] == 0.5
+    assert report['promoted'] is True
+    assert json.loads(ml_app.redis_client.store['ml:model:config:global']) == report['best']['config']
+    assert ml_app.models['global'].n_estimators == 50
+
+
+def test_contamination_must_be_a_fraction(ml_app):
+    """'auto' and out-of-range contamination values are rejected"""
+    from pydantic import ValidationError
+
+    for contamination in (['auto'], [0], [0.6]):
+        with pytest.raises(ValidationError):
+            ml_app.EvaluationRequest(contamination=contamination)
+
+
+def test_train_model_uses_promoted_config(ml_app, monkeypatch):
+    """Periodic retraining reads back the promoted configuration"""
+    use_frame(ml_app, monkeypatch, training_frame())
+    config = {'contamination': 0.05, 'n_estimators': 30, 'max_samples': 64}
+    asyncio.run(ml_app.redis_client.set('ml:model:config:global', json.dumps(config)))
+
+    asyncio.run(ml_app.train_model())
+
+    model = ml_app.models['global']
+    assert (model.contamination, model.n_estimators, model.max_samples) == (0.05, 30, 64)
+    metrics = json.loads(ml_app.redis_client.store['ml:model:metrics:global'])
+    assert metrics['contamination'] == 0.05
+    assert metrics['samples'] == 200
+
+
+def test_evaluation_request_bounds(ml_app):
+    """test_size and n_jobs are validated by the request model"""
+    from pydantic import ValidationError
+
+    assert 1 <= ml_app.EvaluationRequest().n_jobs == evaluation.DEFAULT_N_JOBS
+    for kwargs in ({'test_size': 0}, {'test_size': 1}, {'n_jobs': -1}):
+        with pytest.raises(ValidationError):
+            ml_app.EvaluationRequest(**kwargs)
+
+
+def test_cli_promotes_through_service(monkeypatch, capsys):
+    """CLI promotion is delegated to the running service"""
+    httpx = pytest.importorskip('httpx')
+    calls = []
+
+    class FakeResponse:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {'promoted': True}
+
+    def fake_post(url, json, headers, timeout):
+        calls.append((url, json, headers))
+        return FakeResponse()
+
+    async def fail_locally(payload):
+        raise AssertionError("promotion must not run in the CLI process")
+
+    monkeypatch.setattr(httpx, 'post', fake_post)
+    monkeypatch.setattr(evaluation, '_evaluate_locally', fail_locally)
+    monkeypatch.setenv('ML_ADMIN_TOKEN', 'secret')
+    monkeypatch.setattr('sys.argv', ['evaluation.py', '--promote', '--service-url', 'http://ml:8000/'])
+
+    evaluation.main()
+
+    url, payload, headers = calls[0]
+    assert url == 'http://ml:8000/api/admin/model/evaluate'
+    assert payload['promote'] is True
+    assert headers == {'X-Admin-Token': 'secret'}
+    assert json.loads(capsys.readouterr().out) == {'promoted': True}
+
+
+def test_feedback_overrides_anomaly_status(ml_app, monkeypatch):
+    """actual_anomaly feedback takes precedence over is_anomaly"""
+    df = training_frame(n=5, anomalies=2)
+    use_frame(ml_app, monkeypatch, df, feedback=[('ph-0', True), ('ph-4', False)])
+
+    X, y, has_feedback, meta = asyncio.run(ml_app.get_labelled_feature_matrix())
+
+    assert list(y) == [1, 0, 0, 1, 0]
+    assert list(has_feedback) == [True, False, False, False, True]
+    assert X.shape == (5, 7)
+    assert meta['feedback_labels'] == 2
+    assert meta['anomalies'] == 2
+
+    # The cached matrix is reused until refresh is requested
+    use_frame(ml_app, monkeypatch, df)
+    assert list(asyncio.run(ml_app.get_labelled_feature_matrix())[1]) == [1, 0, 0, 1, 0]
+    assert list(asyncio.run(ml_app.get_labelled_feature_matrix(refresh=True))[1]) == [0, 0, 0, 1, 1]
+
+
+def test_promote_config(ml_app, tmp_path, labelled_matrix):
+    """Promotion activates, saves and records the configuration"""
+    X, _, _ = labelled_matrix
+    config = {'contamination': 0.05, 'n_estimators': 20, 'max_samples': 'auto'}
+
+    asyncio.run(ml_app.promote_config('route-1', config, X))
+
+    assert ml_app.models['route-1'].n_estimators == 20
+    assert 'route-1' in ml_app.scalers
+    assert (tmp_path / 'route-1_model.pkl').exists()
+    assert json.loads(ml_app.redis_client.store['ml:model:config:route-1']) == config
+
+
+def test_route_id_must_be_a_uuid(ml_app):
+    """route_id reaches file paths, so only UUIDs are accepted"""
+    from pydantic import ValidationError
+
+    with pytest.raises(ValidationError):
+        ml_app.EvaluationRequest(route_id='../x')
+
+    route_id = '3f2504e0-4f89-11d3-9a0c-0305e82c3301'
+    assert str(ml_app.EvaluationRequest(route_id=route_id).route_id) == route_id
+
+
+def test_baseline_matches_train_model_defaults(ml_app, monkeypatch):
+    """The baseline ignores feedback, like train_model does"""
+    df = training_frame(n=200, anomalies=10)
+    # Feedback flips every detected anomaly to a false positive
+    use_frame(ml_app, monkeypatch, df, feedback=[(f'ph-{i}', False) for i in range(190, 200)])
+
+    request = ml_app.EvaluationRequest(contamination=[0.05], n_estimators=[50], max_samples=['auto'], n_jobs=1)
+    report = asyncio.run(ml_app.run_evaluation(request))
+
+    assert report['dataset']['detector_anomaly_rate'] == 0.05
+    assert report['baseline']['config'] == {'contamination': 0.05, 'n_estimators': 200, 'max_samples': 'auto'}
+
+
+def test_latency_is_measured_after_parallel_fits(labelled_matrix, monkeypatch):
+    """Scoring latency is timed sequentially in the parent process"""
+    import os
+
+    X, y, feedback = labelled_matrix
+    timed_in = []
+    measure_latency = evaluation.measure_latency
+
+    def spy(model, row):
+        timed_in.append(os.getpid())
+        return measure_latency(model, row)
+
+    monkeypatch.setattr(evaluation, 'measure_latency', spy)
+    report = evaluation.run_grid(X, y, feedback, evaluation.build_grid([0.05], [20, 30], ['auto']), n_jobs=2)
+
+    assert timed_in == [os.getpid()] * 2
+    assert all(r['latency_p50_ms'] > 0 for r in report['results'])
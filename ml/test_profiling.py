@@ -0,0 +1,164 @@
+import asyncio
+import marshal
+import time
+
+import pytest
+
+import profiling
+from profiling import profiled, ProfilingError
+
+
+@profiled('busy', allocations=True)
+async def busy():
+    data = [i * i for i in range(20000)]
+    await asyncio.sleep(0)
+    return len(data)
+
+
+@pytest.fixture(autouse=True)
+def reset_profiling():
+    profiling.stop_session()
+    profiling._last_report = None
+    yield
+    profiling.stop_session()
+
+
+def test_profiled_passthrough_without_session():
+    """Without a session the wrapped function just runs"""
+    assert asyncio.run(busy()) == 20000
+    assert profiling.get_status() == {'active': False, 'last_report_available': False}
+
+
+def test_timing_session_records_calls():
+    """Timing mode aggregates per-function durations"""
+    profiling.start_session('timing', 5)
+    asyncio.run(busy())
+    asyncio.run(busy())
+    report = profiling.stop_session()
+
+    assert report['timings']['busy']['calls'] == 2
+    assert profiling.export_report('json')
+    with pytest.raises(ProfilingError):
+        profiling.export_report('pstats')
+
+
+def test_cprofile_session_exports_pstats():
+    """cProfile mode exports marshalled pstats"""
+    profiling.start_session('cprofile', 5)
+    asyncio.run(busy())
+    profiling.stop_session()
+
+    stats = marshal.loads(profiling.export_report('pstats'))
+    assert any(func[2] == 'busy' for func in stats)
+
+
+def test_sampling_session_exports_collapsed_stacks():
+    """Sampling mode exports collapsed stacks"""
+    profiling.start_session('sampling', 5, sample_interval_ms=1)
+    deadline = time.monotonic() + 0.1
+    while time.monotonic() < deadline:
+        sum(range(1000))
+    profiling.stop_session()
+
+    collapsed = profiling.export_report('collapsed').decode()
+    assert collapsed
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in collapsed.splitlines())
+
+
+def test_allocation_snapshots():
+    """Allocation snapshots are captured for instrumented calls"""
+    profiling.start_session('timing', 5, trace_allocations=True)
+    asyncio.run(busy())
+    report = profiling.stop_session()
+
+    assert report['allocations'][0]['function'] == 'busy'
+    assert report['allocations'][0]['top']
+
+
+def test_session_validation():
+    """Only one bounded session at a time"""
+    with pytest.raises(ProfilingError):
+        profiling.start_session('unknown', 5)
+    with pytest.raises(ProfilingError):
+        profiling.start_session('timing', profiling.MAX_PROFILING_DURATION + 1)
+
+    session = profiling.start_session('timing', 5)
+    with pytest.raises(ProfilingError):
+        profiling.start_session('timing', 5)
+
+    # Auto-stop of an older session must not stop the current one
+    assert profiling.stop_session(object()) is None
+    assert profiling.stop_session(session) is not None
+
+
+@pytest.fixture
+def client(monkeypatch):
+    app = pytest.importorskip('app')
+    from fastapi.testclient import TestClient
+
+    # No "with" block: the lifespan (DB, Redis) is not started
+    monkeypatch.setattr(app, 'ML_ADMIN_TOKEN', 'secret')
+    return TestClient(app.app)
+
+
+ADMIN = {'X-Admin-Token': 'secret'}
+
+
+def test_admin_endpoints_disabled_without_token(client, monkeypatch):
+    """Admin endpoints are refused when ML_ADMIN_TOKEN is unset"""
+    import app
+    monkeypatch.setattr(app, 'ML_ADMIN_TOKEN', None)
+
+    response = client.get('/api/admin/profiling/status', headers=ADMIN)
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize('headers', [{}, {'X-Admin-Token': 'wrong'}])
+def test_admin_endpoints_reject_bad_token(client, headers):
+    """Missing or wrong token is refused"""
+    assert client.get('/api/admin/profiling/status', headers=headers).status_code == 403
+    assert client.post('/api/admin/profiling/start', json={}, headers=headers).status_code == 403
+    assert profiling.get_status()['active'] is False
+
+
+def test_profiling_endpoints_round_trip(client):
+    """Start, stop then download the report"""
+    response = client.post('/api/admin/profiling/start',
+                           json={'mode': 'cprofile', 'duration_seconds': 5}, headers=ADMIN)
+    assert response.status_code == 200
+    assert response.json()['active'] is True
+
+    assert client.post('/api/admin/profiling/stop', headers=ADMIN).status_code == 200
+    assert client.post('/api/admin/profiling/stop', headers=ADMIN).status_code == 404
+
+    response = client.get('/api/admin/profiling/report', params={'format': 'pstats'}, headers=ADMIN)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/octet-stream'
+    assert response.headers['content-disposition'].startswith('attachment; filename="ml-profile-')
+    assert response.headers['content-disposition'].endswith('.prof"')
+    marshal.loads(response.content)
+
+    response = client.get('/api/admin/profiling/report', params={'format': 'json'}, headers=ADMIN)
+    assert response.json()['mode'] == 'cprofile'
+
+
+def test_profiling_report_format_validation(client):
+    """Unknown formats are rejected, unavailable ones are not found"""
+    response = client.get('/api/admin/profiling/report', params={'format': 'svg'}, headers=ADMIN)
+    assert response.status_code == 400
+
+    response = client.get('/api/admin/profiling/report', params={'format': 'json'}, headers=ADMIN)
+    assert response.status_code == 404
+
+    client.post('/api/admin/profiling/start', json={'mode': 'timing', 'duration_seconds': 5}, headers=ADMIN)
+    client.post('/api/admin/profiling/stop', headers=ADMIN)
+    response = client.get('/api/admin/profiling/report', params={'format': 'collapsed'}, headers=ADMIN)
+    assert response.status_code == 404
+
+
+def test_profiling_start_validation(client):
+    """Invalid sessions are rejected with 400"""
+    response = client.post('/api/admin/profiling/start',
+                           json={'mode': 'timing', 'duration_seconds': profiling.MAX_PROFILING_DURATION + 1},
+                           headers=ADMIN)
+    assert response.status_code == 400